@@ -4,12 +4,18 @@ MoveOnJoy Subdomain Rotator for M3U Playlists
 GitHub Actions Version
 """
 
-import asyncio
 import re
-import aiofiles
 import os
+import itertools
 from pathlib import Path
 
+# Matches a MoveOnJoy host such as fl7.moveonjoy.com, the playlist is
+# processed as raw bytes since the hosts are plain ASCII
+SUBDOMAIN_PATTERN = re.compile(rb'fl\d+\.moveonjoy\.com')
+
+# How many individual replacements to print in the summary
+EXAMPLE_CHANGES = 5
+
 class M3USubdomainRotator:
     def __init__(self, m3u_path: str, rotation_range: tuple = (1, 100)):
         self.m3u_path = Path(m3u_path)
@@ -17,47 +23,51 @@ class M3USubdomainRotator:
         self.current_subdomain = rotation_range[0]
         self.processed_lines = 0
         self.changed_lines = 0
+        # Every host in the rotation, built once
+        self._rotation = [
+            f"fl{i}.moveonjoy.com".encode() for i in range(rotation_range[0], rotation_range[1] + 1)
+        ]
     
-    def _get_next_subdomain(self):
-        subdomain = f"fl{self.current_subdomain}"
-        self.current_subdomain += 1
-        if self.current_subdomain > self.rotation_range[1]:
-            self.current_subdomain = self.rotation_range[0]
-        return subdomain
-    
-    async def rotate_subdomains(self):
-        if not self.m3u_path.exists():
+    def rotate_subdomains(self):
+        # Read once up front instead of stat-ing the file and reading it again
+        try:
+            content = self.m3u_path.read_bytes()
+        except FileNotFoundError:
             print(f"❌ File not found: {self.m3u_path}")
             return False
+        except OSError as e:
+            print(f"❌ Error processing file: {e}")
+            return False
         
         print(f"🎬 Starting M3U Subdomain Rotation")
         print(f"📁 File: {self.m3u_path}")
         print(f"🔄 Rotation Range: fl{self.rotation_range[0]} - fl{self.rotation_range[1]}")
         
         try:
-            async with aiofiles.open(self.m3u_path, 'r', encoding='utf-8') as f:
-                content = await f.read()
+            start = self.current_subdomain - self.rotation_range[0]
+            hosts = itertools.cycle(self._rotation[start:] + self._rotation[:start])
+            
+            changes = []
+            
+            def replace_subdomain(match):
+                new_host = next(hosts)
+                changes.append((match.group(0), new_host))
+                return new_host
             
-            lines = content.split('\n')
-            processed_lines = []
+            new_content, self.changed_lines = SUBDOMAIN_PATTERN.subn(replace_subdomain, content)
+            self.current_subdomain = self.rotation_range[0] + (start + self.changed_lines) % len(self._rotation)
+            self.processed_lines = content.count(b'\n') + 1
             
-            for line in lines:
-                self.processed_lines += 1
-                pattern = r'fl\d+\.moveonjoy\.com'
-                matches = re.findall(pattern, line)
-                
-                if matches:
-                    self.changed_lines += 1
-                    for match in set(matches):
-                        old_subdomain = match
-                        new_subdomain = self._get_next_subdomain()
-                        line = line.replace(old_subdomain, f"{new_subdomain}.moveonjoy.com")
-                        print(f"🔄 Changed: {old_subdomain} → {new_subdomain}.moveonjoy.com")
-                
-                processed_lines.append(line)
+            # Nothing matched, leave the file untouched
+            if self.changed_lines:
+                tmp_path = self.m3u_path.with_name(self.m3u_path.name + '.tmp')
+                tmp_path.write_bytes(new_content)
+                tmp_path.replace(self.m3u_path)
             
-            async with aiofiles.open(self.m3u_path, 'w', encoding='utf-8') as f:
-                await f.write('\n'.join(processed_lines))
+            for old_host, new_host in changes[:EXAMPLE_CHANGES]:
+                print(f"🔄 Changed: {old_host.decode()} → {new_host.decode()}")
+            if len(changes) > EXAMPLE_CHANGES:
+                print(f"🔄 ... and {len(changes) - EXAMPLE_CHANGES} more")
             
             print(f"✅ Rotation Complete!")
             print(f"📊 Summary:")
@@ -71,11 +81,11 @@ class M3USubdomainRotator:
             print(f"❌ Error processing file: {e}")
             return False
 
-async def main():
+def main():
     rotator = M3USubdomainRotator("PrimeVision/us.m3u")
-    success = await rotator.rotate_subdomains()
+    success = rotator.rotate_subdomains()
     if not success:
         raise Exception("Rotation failed!")
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    main()
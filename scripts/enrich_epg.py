@@ -1,30 +1,85 @@
 import asyncio
 import aiohttp
-import xml.etree.ElementTree as ET
+from lxml import etree as ET
 import sys
 import os
+import re
+import json
+import time
+import hashlib
 import logging
+import queue
+import atexit
+from logging.handlers import QueueHandler, QueueListener
+from collections import deque
 from datetime import datetime
 from genre_colors import get_color_for_genre
-
-# Configure logging
+from generate_genres import add_programme_genres, generate_genres_xml
+from event_loop import run
+
+try:
+    # orjson decodes TMDb payloads several times faster, stdlib json is the fallback
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+# Configure logging, per-programme progress is only shown with LOG_LEVEL=DEBUG.
+# Records are written to stdout by a listener thread, the event loop only queues them.
+_log_queue = queue.SimpleQueue()
 logging.basicConfig(
-    level=logging.INFO,
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
     format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[logging.StreamHandler(sys.stdout)]
+    handlers=[QueueHandler(_log_queue)]
 )
+_log_listener = QueueListener(_log_queue, logging.StreamHandler(sys.stdout))
+_log_listener.start()
+atexit.register(_log_listener.stop)
 log = logging.getLogger(__name__)
 
 # TMDB Setup
-TMDB_API_KEY = os.getenv("TMDB_API_KEY") or (len(sys.argv) > 3 and sys.argv[3])
+TMDB_API_KEY = os.getenv("TMDB_API_KEY") or (sys.argv[3] if len(sys.argv) > 3 else None)
 if not TMDB_API_KEY:
     log.error("❌ TMDB_API_KEY is required.")
     sys.exit(1)
 
 TMDB_BASE = "https://api.themoviedb.org/3"
-TMDB_IMAGE_BASE = "https://image.tmdb.org/t/p/w780"  # Bigger size than w500
-
-TARGET_CHANNELS = {
+# Poster width written into the guide, defaults to w780 for a bigger poster than w500
+TMDB_POSTER_SIZES = ("w92", "w154", "w185", "w342", "w500", "w780", "original")
+TMDB_POSTER_SIZE = os.getenv("TMDB_POSTER_SIZE", "w780")
+if TMDB_POSTER_SIZE not in TMDB_POSTER_SIZES:
+    log.error("❌ TMDB_POSTER_SIZE must be one of %s, got %r.", ", ".join(TMDB_POSTER_SIZES), TMDB_POSTER_SIZE)
+    sys.exit(1)
+TMDB_IMAGE_BASE = f"https://image.tmdb.org/t/p/{TMDB_POSTER_SIZE}"
+GENRES_FILE = "genres.xml"
+
+# Upper bound on TMDb requests in flight at once
+TMDB_CONCURRENCY = int(os.getenv("TMDB_CONCURRENCY", "20"))
+TMDB_SEMAPHORE = asyncio.Semaphore(TMDB_CONCURRENCY)
+# Requests per second, kept under TMDb's documented rate limit
+TMDB_RATE = float(os.getenv("TMDB_RATE", "40"))
+_next_request_at = 0.0
+TMDB_TIMEOUT = 30
+# 429 and 5xx answers are retried with exponential backoff
+TMDB_RETRIES = 5
+TMDB_RETRY_BACKOFF = 1
+# After this many requests in a row exhaust their retries, stop asking for a while
+TMDB_BREAKER_THRESHOLD = 5
+TMDB_BREAKER_COOLDOWN = 60
+_breaker = {"failures": 0, "open_until": 0.0, "half_open": False, "down": False}
+
+# TMDb responses are cached on disk between runs and in memory within a run
+CACHE_DIR = os.path.join(".cache", "tmdb")
+CACHE_TTL = 24 * 60 * 60
+# Movie metadata rarely changes once released, TV gets new seasons and episodes
+MOVIE_CACHE_TTL = 7 * CACHE_TTL
+_response_cache = {}
+_inflight = {}
+_title_cache = {}
+
+# Top-level EPG elements held in memory while waiting on earlier enrichments
+STREAM_WINDOW = 2000
+
+TARGET_CHANNELS = frozenset({
     "403788", "403674", "403837",
     "403794", "403620", "403772",
     "403655", "403847", "403576", 
@@ -45,7 +100,7 @@ TARGET_CHANNELS = {
     "403889", "403873", "403480",
     "403951", "403564", "403805",
     "403903"
-}
+})
 
 MANUAL_ID_OVERRIDES = {
     "Jessie": {"type": "tv", "id": 38974},
@@ -86,49 +141,207 @@ MANUAL_ID_OVERRIDES = {
     "Electric Bloom": {"type": "tv", "id": 275724}
 }
 
+# Programmes that already carry all of these are copied through without a lookup
+ENRICHED_TAGS = ("icon", "desc", "category", "rating")
+
+# EPG titles carry markers like "New: " or "(HD)" that TMDb and the overrides don't
+TITLE_NOISE = re.compile(r"^(?:new|live|premiere):\s*|\s*\((?:hd|\d{4})\)\s*$", re.IGNORECASE)
+_OVERRIDES_BY_KEY = {title.casefold(): ovr for title, ovr in MANUAL_ID_OVERRIDES.items()}
+
 TMDB_GENRES = {
     16: "Animation", 35: "Comedy", 10751: "Family", 10762: "Kids", 18: "Drama",
     28: "Action", 10759: "Adventure", 12: "Adventure", 14: "Fantasy", 27: "Horror",
     10402: "Music", 9648: "Mystery", 878: "Sci-Fi", 10765: "Sci-Fi & Fantasy",
     10766: "Soap", 10767: "Talk", 10768: "War & Politics"
 }
+# TMDB_GENRES plus every id from TMDb's genre lists, filled in by load_genres
+_genre_names = dict(TMDB_GENRES)
 
 # TMDb API Helpers
 
-async def fetch_json(session, url, params):
-    async with session.get(url, params=params) as resp:
-        return await resp.json()
+def genre_names(details):
+    # Genre ids arrive as ints, one dict lookup each, unknown ids are dropped
+    genres = (_genre_names.get(g["id"]) for g in details.get("genres", []))
+    return [name for name in genres if name]
+
+async def fetch_json(session, url, params, etag=None):
+    """Returns (body, etag), body is None when TMDb answers 304 Not Modified."""
+    headers = {"If-None-Match": etag} if etag else None
+    for attempt in range(TMDB_RETRIES):
+        # Attempts let through once a cooldown has ended are the half-open trials
+        trial = await wait_for_breaker()
+        error = None
+        try:
+            async with TMDB_SEMAPHORE:
+                await throttle()
+                async with session.get(url, params=params, headers=headers) as resp:
+                    if resp.status == 304:
+                        record_result(ok=True)
+                        return None, etag
+                    if resp.status != 429 and resp.status < 500:
+                        # TMDb answered, a body that doesn't decode is final, not an outage
+                        record_result(ok=True)
+                        return await resp.json(loads=json_loads), resp.headers.get("ETag")
+                    reason = f"TMDb answered {resp.status}"
+                    delay = retry_delay(resp, attempt)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            # Dropped connections and timeouts are as transient as a 5xx
+            error = e
+            reason = f"TMDb request failed ({type(e).__name__})"
+            delay = TMDB_RETRY_BACKOFF * 2 ** attempt
+        # Right after a cooldown one failed attempt is enough to give up
+        if attempt == TMDB_RETRIES - 1 or trial:
+            break
+        # Back off outside the semaphore so other requests keep going
+        log.warning("⏳ %s, retrying in %.1fs", reason, delay)
+        await asyncio.sleep(delay)
+
+    record_result(ok=False, trial=trial)
+    raise RuntimeError(f"{reason} after {attempt + 1} attempts") from error
+
+async def wait_for_breaker():
+    """Hold requests back while the breaker is open, fail them once TMDb is down.
+
+    Returns True when the breaker is half-open, i.e. this attempt is a trial.
+    """
+    loop = asyncio.get_running_loop()
+    while _breaker["open_until"] > loop.time():
+        await asyncio.sleep(_breaker["open_until"] - loop.time())
+    if _breaker["down"]:
+        raise RuntimeError("TMDb is unavailable, skipping request")
+    return _breaker["half_open"]
+
+def record_result(ok, trial=False):
+    """Open the breaker for TMDB_BREAKER_COOLDOWN after repeated exhausted retries.
+
+    The first requests after the cooldown are half-open trials: a success closes
+    the breaker, a failure marks TMDb down for the rest of the run.
+    """
+    if ok:
+        _breaker["failures"] = 0
+        _breaker["half_open"] = False
+        return
+    if _breaker["half_open"]:
+        # Requests that started before the breaker opened don't decide the trial
+        if trial and not _breaker["down"]:
+            _breaker["down"] = True
+            log.error("🚫 TMDb still failing after the cooldown, skipping the remaining lookups")
+        return
+    _breaker["failures"] += 1
+    if _breaker["failures"] >= TMDB_BREAKER_THRESHOLD:
+        _breaker["failures"] = 0
+        _breaker["half_open"] = True
+        _breaker["open_until"] = asyncio.get_running_loop().time() + TMDB_BREAKER_COOLDOWN
+        log.error("🚫 TMDb keeps failing, pausing requests for %ss", TMDB_BREAKER_COOLDOWN)
+
+async def throttle():
+    """Space requests at least 1 / TMDB_RATE seconds apart."""
+    global _next_request_at
+    now = asyncio.get_running_loop().time()
+    start = max(now, _next_request_at)
+    _next_request_at = start + 1 / TMDB_RATE
+    if start > now:
+        await asyncio.sleep(start - now)
+
+def retry_delay(resp, attempt):
+    try:
+        return float(resp.headers["Retry-After"])
+    except (KeyError, ValueError):
+        return TMDB_RETRY_BACKOFF * 2 ** attempt
+
+def cache_key(url, params):
+    # The API key is left out so rotating it doesn't throw the cache away
+    items = sorted((k, str(v)) for k, v in params.items() if k != "api_key")
+    return hashlib.blake2b(repr((url, items)).encode(), digest_size=16).hexdigest()
+
+def cache_ttl(url):
+    # Genre lists change about as rarely as movie metadata
+    if url.startswith((f"{TMDB_BASE}/movie/", f"{TMDB_BASE}/genre/")):
+        return MOVIE_CACHE_TTL
+    return CACHE_TTL
+
+def read_cache(key, ttl=CACHE_TTL):
+    """Returns (entry, fresh), entry is None when nothing usable is cached."""
+    path = os.path.join(CACHE_DIR, f"{key}.json")
+    try:
+        age = time.time() - os.path.getmtime(path)
+        with open(path, "rb") as f:
+            entry = json_loads(f.read())
+    except (OSError, ValueError):
+        return None, False
+    if not isinstance(entry, dict) or "body" not in entry:
+        return None, False
+    return entry, age <= ttl
+
+def write_cache(key, entry):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = os.path.join(CACHE_DIR, f"{key}.json")
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(entry, f)
+    os.replace(tmp_path, path)
+
+async def cached_fetch_json(session, url, params):
+    key = cache_key(url, params)
+    if key in _response_cache:
+        return _response_cache[key]
+
+    # Concurrent callers of the same request, e.g. the season lists of a show
+    # airing in several slots, wait on one fetch instead of each sending it
+    task = _inflight.get(key)
+    if task is None:
+        task = _inflight[key] = asyncio.create_task(load_json(session, url, params, key))
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    return await asyncio.shield(task)
+
+async def load_json(session, url, params, key):
+    entry, fresh = read_cache(key, cache_ttl(url))
+    if fresh:
+        data = entry["body"]
+    else:
+        # A stale entry is revalidated with its ETag, a 304 costs no body
+        data, etag = await fetch_json(session, url, params, entry and entry.get("etag"))
+        if data is None:
+            data = entry["body"]
+        # TMDb error bodies carry "success": false, they are kept for this run
+        # (e.g. the 404 that ends a season list) but never written to disk
+        elif isinstance(data, dict) and data.get("success") is not False:
+            write_cache(key, {"etag": etag, "body": data})
+
+    _response_cache[key] = data
+    return data
 
 async def get_details(session, content_type, content_id):
-    return await fetch_json(session, f"{TMDB_BASE}/{content_type}/{content_id}", {"api_key": TMDB_API_KEY})
-
-async def get_credits(session, content_type, content_id):
-    data = await fetch_json(session, f"{TMDB_BASE}/{content_type}/{content_id}/credits", {"api_key": TMDB_API_KEY})
+    # Credits and ratings come back in the same response instead of two more requests
+    ratings = "release_dates" if content_type == "movie" else "content_ratings"
+    return await cached_fetch_json(session, f"{TMDB_BASE}/{content_type}/{content_id}", {
+        "api_key": TMDB_API_KEY, "append_to_response": f"credits,{ratings}"
+    })
+
+def credits_from(details):
+    data = details.get("credits", {})
     cast = [c["name"] for c in data.get("cast", [])]
     directors = [c["name"] for c in data.get("crew", []) if c.get("job") == "Director"]
     return cast, directors[0] if directors else None
 
-async def get_rating(session, content_type, content_id):
+def rating_from(content_type, details):
     endpoint = "release_dates" if content_type == "movie" else "content_ratings"
-    data = await fetch_json(session, f"{TMDB_BASE}/{content_type}/{content_id}/{endpoint}", {"api_key": TMDB_API_KEY})
-    for r in data.get("results", []):
-        if r.get("iso_3166_1") == "US":
-            if content_type == "movie":
-                for rel in r.get("release_dates", []):
-                    if rel.get("certification"):
-                        return rel.get("certification")
-            else:
-                return r.get("rating")
-    return "Not Rated"
+    data = details.get(endpoint, {})
+    us = next((r for r in data.get("results", []) if r.get("iso_3166_1") == "US"), None)
+    if us is None:
+        return "Not Rated"
+    if content_type != "movie":
+        return us.get("rating")
+    return next((rel["certification"] for rel in us.get("release_dates", []) if rel.get("certification")), "Not Rated")
 
 async def get_episode_info(session, tv_id, airdate_str):
     try:
         airdate = datetime.strptime(airdate_str, "%Y%m%d").date()
-    except:
+    except ValueError:
         return None, None, None, None
 
     for season in range(1, 100):
-        data = await fetch_json(session, f"{TMDB_BASE}/tv/{tv_id}/season/{season}", {"api_key": TMDB_API_KEY})
+        data = await cached_fetch_json(session, f"{TMDB_BASE}/tv/{tv_id}/season/{season}", {"api_key": TMDB_API_KEY})
         for ep in data.get("episodes", []):
             if ep.get("air_date") == airdate.isoformat():
                 return season, ep["episode_number"], ep["name"], ep["overview"]
@@ -138,74 +351,93 @@ async def get_episode_info(session, tv_id, airdate_str):
 
 # Main Enrichment Logic
 
-async def process_programme(session, programme):
-    title_el = programme.find("title")
-    channel = programme.get("channel")
-    if title_el is None or not channel or channel not in TARGET_CHANNELS:
-        return
+def is_target(programme):
+    return (
+        programme.get("channel") in TARGET_CHANNELS
+        and bool(programme.findtext("title", "").strip())
+        and not is_enriched(programme)
+    )
+
+def is_enriched(programme):
+    # The source or an earlier run already filled in everything TMDb would add
+    return all(programme.find(tag) is not None for tag in ENRICHED_TAGS)
+
+def normalize_title(title):
+    return TITLE_NOISE.sub("", title).strip()
+
+def find_or_add(parent, tag):
+    # Elements without children are falsy, so `find(...) or ...` is not enough
+    el = parent.find(tag)
+    return el if el is not None else ET.SubElement(parent, tag)
+
+async def lookup_title(session, title):
+    """Resolve a title to its TMDb data, None when there is no match."""
+    ovr = _OVERRIDES_BY_KEY.get(title.casefold())
+    if ovr:
+        content_type, content_id = ovr["type"], ovr["id"]
+    else:
+        search = await cached_fetch_json(session, f"{TMDB_BASE}/search/multi", {
+            "api_key": TMDB_API_KEY, "query": title
+        })
+        result = next((r for r in search.get("results", []) if r["media_type"] in ("tv", "movie")), None)
+        if not result:
+            return None
+        content_type, content_id = result["media_type"], result["id"]
+
+    details = await get_details(session, content_type, content_id)
+    cast, director = credits_from(details)
+    first_air_date_raw = details.get("first_air_date") or details.get("release_date")
+    return {
+        "title": details.get("name") or details.get("title"),
+        "poster": TMDB_IMAGE_BASE + details["poster_path"] if details.get("poster_path") else "",
+        "description": details.get("overview", "").strip(),
+        "genres": genre_names(details),
+        "year": first_air_date_raw[:4] if first_air_date_raw else "",
+        "first_air_date": datetime.strptime(first_air_date_raw, "%Y-%m-%d").strftime("%d/%m/%Y") if first_air_date_raw else "",
+        "rating": rating_from(content_type, details),
+        "cast": cast,
+        "director": director,
+        "id": content_id,
+        "type": content_type
+    }
+
+async def get_title_data(session, title):
+    # Titles repeat across many slots, every slot shares one lookup task
+    name = normalize_title(title) or title
+    key = name.casefold()
+    task = _title_cache.get(key)
+    if task is None:
+        task = _title_cache[key] = asyncio.create_task(lookup_title(session, name))
+        # A failed lookup is forgotten so a later slot of the same title tries again
+        task.add_done_callback(lambda t: t.cancelled() or t.exception() is None or _title_cache.pop(key, None))
+    return await asyncio.shield(task)
 
-    title = title_el.text.strip()
-    log.info(f"📺 Processing: {title}")
+async def process_programme(session, programme):
+    title = programme.findtext("title").strip()
+    log.debug("📺 Processing: %s", title)
 
     start = programme.get("start")
     airdate_str = start[:8] if start else None
 
     try:
-        if title in MANUAL_ID_OVERRIDES:
-            ovr = MANUAL_ID_OVERRIDES[title]
-            details = await get_details(session, ovr["type"], ovr["id"])
-            rating = await get_rating(session, ovr["type"], ovr["id"])
-            cast, director = await get_credits(session, ovr["type"], ovr["id"])
-            first_air_date_raw = details.get("first_air_date") or details.get("release_date")
-            data = {
-                "title": details.get("name") or details.get("title"),
-                "poster": TMDB_IMAGE_BASE + (details.get("poster_path") or ""),
-                "description": details.get("overview", "").strip(),
-                "genres": [TMDB_GENRES.get(g["id"]) for g in details.get("genres", []) if TMDB_GENRES.get(g["id"])],
-                "year": first_air_date_raw[:4] if first_air_date_raw else "",
-                "first_air_date": datetime.strptime(first_air_date_raw, "%Y-%m-%d").strftime("%d/%m/%Y") if first_air_date_raw else "",
-                "rating": rating,
-                "cast": cast,
-                "director": director,
-                "id": ovr["id"],
-                "type": ovr["type"]
-            }
-        else:
-            search = await fetch_json(session, f"{TMDB_BASE}/search/multi", {
-                "api_key": TMDB_API_KEY, "query": title
-            })
-            result = next((r for r in search.get("results", []) if r["media_type"] in ("tv", "movie")), None)
-            if not result:
-                log.warning(f"❌ No match found for: {title}")
-                return
-            content_type = result["media_type"]
-            content_id = result["id"]
-            details = await get_details(session, content_type, content_id)
-            rating = await get_rating(session, content_type, content_id)
-            cast, director = await get_credits(session, content_type, content_id)
-            first_air_date_raw = details.get("first_air_date") or details.get("release_date")
-            data = {
-                "title": details.get("name") or details.get("title"),
-                "poster": TMDB_IMAGE_BASE + (details.get("poster_path") or ""),
-                "description": details.get("overview", "").strip(),
-                "genres": [TMDB_GENRES.get(g["id"]) for g in details.get("genres", []) if TMDB_GENRES.get(g["id"])],
-                "year": first_air_date_raw[:4] if first_air_date_raw else "",
-                "first_air_date": datetime.strptime(first_air_date_raw, "%Y-%m-%d").strftime("%d/%m/%Y") if first_air_date_raw else "",
-                "rating": rating,
-                "cast": cast,
-                "director": director,
-                "id": content_id,
-                "type": content_type
-            }
+        data = await get_title_data(session, title)
+        if data is None:
+            log.warning("❌ No match found for: %s", title)
+            return
 
         if data["poster"]:
             ET.SubElement(programme, "icon", {"src": data["poster"]})
 
-        desc_el = programme.find("desc") or ET.SubElement(programme, "desc")
+        desc_el = find_or_add(programme, "desc")
         desc_text = data["description"]
 
         if data["type"] == "tv" and airdate_str:
-            season, episode, ep_title, ep_overview = await get_episode_info(session, data["id"], airdate_str)
+            try:
+                season, episode, ep_title, ep_overview = await get_episode_info(session, data["id"], airdate_str)
+            except (aiohttp.ClientError, asyncio.TimeoutError, RuntimeError, ValueError) as e:
+                # Keep the show-level enrichment when only the episode lookup fails
+                log.warning("⚠️ Episode lookup failed for %s: %s", title, e)
+                season = episode = ep_title = ep_overview = None
             if season and episode:
                 ET.SubElement(programme, "episode-num", {"system": "xmltv_ns"}).text = f"{season-1}.{episode-1}."
                 ET.SubElement(programme, "episode-num", {"system": "onscreen"}).text = f"S{season}E{episode}"
@@ -229,7 +461,7 @@ async def process_programme(session, programme):
             cat_el.set("color", get_color_for_genre(g))
 
         if data["first_air_date"]:
-            date_el = programme.find("date") or ET.SubElement(programme, "date")
+            date_el = find_or_add(programme, "date")
             date_el.text = data["first_air_date"]
 
         if data["rating"] and data["rating"] not in ("", "Not Rated"):
@@ -239,35 +471,128 @@ async def process_programme(session, programme):
 
 
         if data["cast"] or data["director"]:
-            credits = programme.find("credits") or ET.SubElement(programme, "credits")
+            credits = find_or_add(programme, "credits")
             if data["director"]:
                 ET.SubElement(credits, "director").text = data["director"]
             for actor in data["cast"][:6]:
                 ET.SubElement(credits, "actor").text = actor
 
-        log.info(f"✅ Enriched: {title}")
+        log.debug("✅ Enriched: %s", title)
 
     except Exception as e:
-        log.error(f"❌ Error processing {title}: {e}")
+        log.error("❌ Error processing %s: %s", title, e)
 
 # Runner
 
 async def enrich_epg(input_file, output_file):
-    tree = ET.parse(input_file)
-    root = tree.getroot()
-    programmes = root.findall("programme")
-
-    async with aiohttp.ClientSession() as session:
-        await asyncio.gather(*[
-            asyncio.create_task(process_programme(session, p)) for p in programmes
-            if p.get("channel") in TARGET_CHANNELS
-        ])
+    # Every request goes to the single TMDb host, size the pool for it
+    connector = aiohttp.TCPConnector(
+        limit=100,
+        limit_per_host=TMDB_CONCURRENCY,
+        ttl_dns_cache=300,
+        # Outlive the longest retry backoff so idle connections are reused
+        keepalive_timeout=60,
+    )
+    timeout = aiohttp.ClientTimeout(total=TMDB_TIMEOUT)
+    genres = set()
+    tmp_file = f"{output_file}.tmp"
+
+    async with aiohttp.ClientSession(
+        connector=connector,
+        timeout=timeout,
+        headers={"Accept": "application/json"},
+    ) as session:
+        await warm_up(session)
+        await load_genres(session)
+        with ET.xmlfile(tmp_file, encoding="utf-8") as xf:
+            xf.write_declaration()
+            await stream_programmes(session, input_file, xf, genres)
+    os.replace(tmp_file, output_file)
+    log.info("🎉 Enriched EPG saved to %s", output_file)
+
+    # Genres were collected while streaming, no need to parse the output again
+    generate_genres_xml(sorted(genres), GENRES_FILE)
+
+async def warm_up(session):
+    # One request resolves DNS and opens a TLS connection before the first burst
+    try:
+        await fetch_json(session, f"{TMDB_BASE}/configuration", {"api_key": TMDB_API_KEY})
+    except (aiohttp.ClientError, asyncio.TimeoutError, RuntimeError, ValueError) as e:
+        log.warning("⚠️ TMDb warm-up request failed: %s", e)
 
-    tree.write(output_file, encoding="utf-8", xml_declaration=True)
-    log.info(f"🎉 Enriched EPG saved to {output_file}")
+async def load_genres(session):
+    """Add the genre ids missing from TMDB_GENRES, the hand-picked names win."""
+    try:
+        lists = await asyncio.gather(*[
+            cached_fetch_json(session, f"{TMDB_BASE}/genre/{kind}/list", {"api_key": TMDB_API_KEY})
+            for kind in ("movie", "tv")
+        ])
+    except (aiohttp.ClientError, asyncio.TimeoutError, RuntimeError, ValueError) as e:
+        log.warning("⚠️ Could not load TMDb genre lists: %s", e)
+        return
+    for data in lists:
+        for genre in data.get("genres", []):
+            _genre_names.setdefault(genre["id"], genre["name"])
+
+async def stream_programmes(session, input_file, xf, genres):
+    """Parse, enrich and write the EPG one top-level element at a time.
+
+    Elements are written in input order as soon as they and everything before
+    them are done, so only the pending window is ever held in memory.
+    """
+    pending = deque()
+
+    async def flush(keep):
+        # Write every finished head, wait on the oldest only while more than keep are held
+        while pending:
+            elem, task = pending[0]
+            if task is not None and not task.done():
+                if len(pending) <= keep:
+                    return
+                await task
+            pending.popleft()
+            if elem.tag == "programme":
+                add_programme_genres(elem, genres)
+            xf.write(elem, with_tail=False)
+            xf.write("\n")
+            elem.clear()
+
+    context = ET.iterparse(input_file, events=("start", "end"))
+    _, root = next(context)
+    depth = 1
+    try:
+        with xf.element(root.tag, dict(root.attrib)):
+            xf.write("\n")
+            for event, elem in context:
+                if event == "start":
+                    depth += 1
+                    continue
+                depth -= 1
+                if depth != 1:
+                    continue
+
+                task = None
+                # Only target programmes get a task, everything else is copied through
+                if elem.tag == "programme" and is_target(elem):
+                    task = asyncio.create_task(process_programme(session, elem))
+                pending.append((elem, task))
+                # Detach earlier siblings so the parsed tree never grows
+                while elem.getprevious() is not None:
+                    del root[0]
+
+                await flush(keep=STREAM_WINDOW - 1)
+                if task is not None:
+                    # Let the new task start its requests while parsing continues
+                    await asyncio.sleep(0)
+
+            await flush(keep=0)
+    finally:
+        for _, task in pending:
+            if task is not None:
+                task.cancel()
 
 if __name__ == "__main__":
     if len(sys.argv) < 3:
         log.error("Usage: python3 enrich_epg.py epg.xml enriched_epg.xml [TMDB_API_KEY]")
         sys.exit(1)
-    asyncio.run(enrich_epg(sys.argv[1], sys.argv[2]))
+    run(enrich_epg(sys.argv[1], sys.argv[2]))
@@ -0,0 +1,9 @@
+import asyncio
+
+def run(main):
+    """Run a coroutine on uvloop when it is installed, asyncio.run otherwise."""
+    try:
+        from uvloop import run as uvloop_run
+    except ImportError:
+        return asyncio.run(main)
+    return uvloop_run(main)
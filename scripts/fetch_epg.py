@@ -2,20 +2,20 @@ import requests
 import shutil
 import os
 import gzip
-import io
 from datetime import datetime
 
 # === CONFIG ===
 EPG_GZ_URL = "https://epg.pw/xmltv/epg_US.xml.gz"
 OUTPUT_FILE = "epg.xml"
 BACKUP_FILE = f"guide_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xml"
+CHUNK_SIZE = 64 * 1024
 
 # === FUNCTIONALITY ===
 
 def fetch_and_decompress_gz(url, output_file, backup=True):
     try:
         print(f"[INFO] Downloading EPG from: {url}")
-        response = requests.get(url, timeout=30)
+        response = requests.get(url, timeout=30, stream=True)
         response.raise_for_status()
 
         # Backup current XML if exists
@@ -23,13 +23,13 @@ def fetch_and_decompress_gz(url, output_file, backup=True):
             shutil.copyfile(output_file, BACKUP_FILE)
             print(f"[INFO] Backup created: {BACKUP_FILE}")
 
-        # Decompress in memory
-        with gzip.GzipFile(fileobj=io.BytesIO(response.content)) as gz:
-            xml_content = gz.read()
-
-        # Save decompressed XML
-        with open(output_file, "wb") as f:
-            f.write(xml_content)
+        # Decompress while streaming, into a temp file so a failed download
+        # never leaves a truncated EPG behind
+        tmp_file = f"{output_file}.tmp"
+        response.raw.decode_content = True
+        with response, gzip.GzipFile(fileobj=response.raw) as gz, open(tmp_file, "wb") as f:
+            shutil.copyfileobj(gz, f, CHUNK_SIZE)
+        os.replace(tmp_file, output_file)
         print(f"[SUCCESS] EPG saved to: {output_file}")
 
     except Exception as e:
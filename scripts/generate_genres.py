@@ -1,4 +1,4 @@
-import xml.etree.ElementTree as ET
+from lxml import etree as ET
 
 def is_valid_genre(genre):
     """Filter out numeric genres like '35', '10762'."""
@@ -6,18 +6,20 @@ def is_valid_genre(genre):
 
 def extract_genres(epg_file):
     tree = ET.parse(epg_file)
-    root = tree.getroot()
-
     genres = set()
 
-    for programme in root.findall('programme'):
-        for category in programme.findall('category'):
-            genre_text = category.text
-            if is_valid_genre(genre_text):
-                genres.add(genre_text.strip())
+    for programme in tree.getroot().findall('programme'):
+        add_programme_genres(programme, genres)
 
     return sorted(genres)
 
+def add_programme_genres(programme, genres):
+    """Add the genres of a single programme to the given set."""
+    for category in programme.findall('category'):
+        genre_text = category.text
+        if is_valid_genre(genre_text):
+            genres.add(genre_text.strip())
+
 def generate_genres_xml(genres, output_file):
     root = ET.Element("genres")
 
@@ -1,110 +1,304 @@
 import asyncio
 import aiohttp
+import os
 import re
 
+from event_loop import run
+
 # ---- CONFIG ----
 M3U_FILE = "PrimeVision.m3u"
 MAX_FL = 10000
 TIMEOUT = 5
+CONNECT_TIMEOUT = 1.5
+CONCURRENCY = 50
+PER_HOST_LIMIT = 10
+RETRY_BACKOFF = 0.5
+KEEPALIVE = 30
+DNS_CACHE_TTL = 300
+PROBE_BYTES = 1024
+LAST_FL_FILE = ".last_working_subdomain"
+USER_AGENT = "Mozilla/5.0 (compatible; PrimeVision-StreamCheck/1.0)"
+
+# Only the head of a playlist is needed, servers that honour Range send just that
+PROBE_HEADERS = {"Range": f"bytes=0-{PROBE_BYTES - 1}"}
 
-# Regex pattern for MoveOnJoy URLs
-# Captures the number and the path after the domain
-URL_PATTERN = re.compile(r"https?://fl(\d+)\.moveonjoy\.com(/.*)", re.IGNORECASE)
+# Regex pattern for MoveOnJoy URL lines, run once over the whole playlist
+# Captures the URL, the number and the path after the domain
+URL_PATTERN = re.compile(
+    r"^[ \t]*(https?://fl(\d+)\.moveonjoy\.com(/\S*))",
+    re.IGNORECASE | re.MULTILINE,
+)
 
 
-async def is_online(session, url):
+def load_last_fl():
     """
-    Online/offline check:
-    - GET request
-    - Validates HLS playlist contains #EXTM3U
+    Read the last FL that was confirmed online by a previous run, if any.
+    """
+    try:
+        with open(LAST_FL_FILE, "r", encoding="utf-8") as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def save_last_fl(fl):
+    with open(LAST_FL_FILE, "w", encoding="utf-8") as f:
+        f.write(f"{fl}\n")
+
+
+def make_resolver():
+    """
+    Resolve with aiodns when it is installed, so lookups for thousands of
+    flN hosts don't queue on the thread pool behind getaddrinfo.
     """
     try:
-        async with session.get(url, timeout=TIMEOUT) as resp:
-            if resp.status != 200:
+        return aiohttp.AsyncResolver()
+    except RuntimeError:
+        return None
+
+
+async def is_online(session, url, retries=1):
+    """
+    Online/offline check:
+    - Ranged GET request, body is streamed
+    - Validates HLS playlist contains #EXTM3U within the first PROBE_BYTES
+    - Connection failures are retried once after RETRY_BACKOFF
+    """
+    for attempt in range(retries + 1):
+        try:
+            async with session.get(url, headers=PROBE_HEADERS) as resp:
+                if resp.status not in (200, 206):
+                    return False
+                head = await resp.content.read(PROBE_BYTES)
+                return b"#EXTM3U" in head
+        except aiohttp.ClientConnectorError as e:
+            # A reset from a throttled origin is worth another try,
+            # a host that doesn't resolve is not
+            if attempt == retries or isinstance(e, aiohttp.ClientConnectorDNSError):
                 return False
-            body = await resp.text()
-            return "#EXTM3U" in body
-    except Exception:
-        return False
+            await asyncio.sleep(RETRY_BACKOFF * (attempt + 1))
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return False
+    return False
+
+
+def check_once(session, url, checks):
+    """
+    Probe each URL once per run, duplicate playlist lines await the same task.
+    """
+    task = checks.get(url)
+    if task is None:
+        task = checks[url] = asyncio.create_task(is_online(session, url))
+    return task
+
+
+async def probe(session, path, fl):
+    """
+    Check a single flN candidate, returning (fl, online).
+    """
+    return fl, await is_online(session, f"https://fl{fl}.moveonjoy.com{path}")
+
+
+async def probe_range(session, path, fls):
+    """
+    Probe FLs highest first with at most CONCURRENCY in flight, a new probe
+    starts as soon as a slot frees up. Returns the highest online FL as soon
+    as every higher FL has answered and cancels the rest.
+    """
+    sem = asyncio.Semaphore(CONCURRENCY)
+
+    async def guarded(fl):
+        async with sem:
+            return await probe(session, path, fl)
+
+    tasks = {asyncio.create_task(guarded(fl)): fl for fl in fls}
+    pending = set(tasks)
+    best = None
+
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                fl, ok = task.result()
+                if ok and (best is None or fl > best):
+                    best = fl
+            if best is not None and not any(tasks[task] > best for task in pending):
+                break
+    finally:
+        for task in pending:
+            task.cancel()
+        # Let the cancelled probes unwind so their connections are released now
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    return best
+
+
+async def refine(session, path, low, high):
+    """
+    Narrow down the highest online FL in [low, high) when low is known to be
+    online, assuming online FLs sit next to each other. Each round probes up
+    to CONCURRENCY evenly spaced FLs in between and keeps the gap around the
+    highest hit.
+    """
+    while high - low > 1:
+        points = sorted({
+            low + (high - low) * k // (CONCURRENCY + 1) for k in range(1, CONCURRENCY + 1)
+        } - {low})
+        hit = await probe_range(session, path, reversed(points))
+        if hit is None:
+            high = points[0]
+        else:
+            low = hit
+            high = next((p for p in points if p > hit), high)
+    return low
 
 
 async def find_working_subdomain(session, path, current_fl):
     """
-    Scan from current FL down to 1, fallback to fl1 if all offline.
+    Probe log-spaced FLs from current FL down to 1, then narrow in on the
+    highest online FL above the best hit. Falls back to scanning every FL
+    when none of the marks is online. Returns None if all offline.
     """
     effective_max = max(MAX_FL, current_fl)
-    fallback_url = f"https://fl1.moveonjoy.com{path}"
-    found_working = None
+    marks = sorted({effective_max >> i for i in range(effective_max.bit_length())}, reverse=True)
+
+    print(f"   → Testing {len(marks)} marks fl{effective_max} → fl1 ...")
+    best = await probe_range(session, path, marks)
 
-    for fl in range(effective_max, 0, -1):
-        test_url = f"https://fl{fl}.moveonjoy.com{path}"
-        print(f"   → Testing fl{fl} ... ", end="")
-        if await is_online(session, test_url):
-            print("✔ ONLINE")
-            found_working = test_url
-            break
-        print("✘ offline")
+    if best is None:
+        print(f"   → No mark online, testing fl{effective_max} → fl1 ...")
+        rest = set(marks)
+        best = await probe_range(session, path, [
+            fl for fl in range(effective_max, 0, -1) if fl not in rest
+        ])
+    else:
+        above = [fl for fl in marks if fl > best]
+        best = await refine(session, path, best, min(above) if above else best + 1)
 
-    if found_working:
-        return found_working
+    if best is not None:
+        print(f"   ✔ ONLINE: fl{best}")
+        return best
 
     print("   ⚠️ All subdomains offline — forcing fallback → fl1")
-    return fallback_url
+    return None
 
 
-async def fix_url(session, url):
-    match = URL_PATTERN.match(url)
-    if not match:
-        print(f"SKIP (not MoveOnJoy): {url}")
-        return url
+async def scan_once(session, key, path, current_fl, scans):
+    """
+    Share one find_working_subdomain task per key, returns (path, fl) where
+    path is the one the scan actually probed.
+    """
+    entry = scans.get(key)
+    if entry is None:
+        entry = scans[key] = (path, asyncio.create_task(
+            find_working_subdomain(session, path, current_fl)
+        ))
+    scan_path, scan = entry
+    return scan_path, await scan
 
-    current_fl, path = match.groups()
-    current_fl = int(current_fl)
 
+async def fix_url(session, url, current_fl, path, scans, checks, last_fl=None):
+    """
+    Returns (url, fl) where fl is the FL confirmed online, or None when
+    the fl1 fallback was used.
+    """
     print(f"\n🔍 Checking: {url}")
 
-    # Check if original is online
-    if await is_online(session, url):
+    # Check the original and the FL that worked last run at the same time,
+    # the original still wins when both are online
+    pending = [check_once(session, url, checks)]
+    last_url = None
+    if last_fl and last_fl != current_fl:
+        last_url = f"https://fl{last_fl}.moveonjoy.com{path}"
+        pending.append(check_once(session, last_url, checks))
+
+    original_ok, *last_ok = await asyncio.gather(*pending)
+
+    if original_ok:
         print(f"   ✅ ONLINE: fl{current_fl} is working")
-        return url
+        return url, current_fl
+
+    if last_ok and last_ok[0]:
+        print(f"   ⚡ REPLACED (last known good): fl{current_fl} → {last_url}")
+        return last_url, last_fl
 
     print(f"   ❌ OFFLINE: fl{current_fl} is down — scanning fl{max(current_fl, MAX_FL)} → fl1 ...")
 
-    working_url = await find_working_subdomain(session, path, current_fl)
+    # Lines on the same host share one scan instead of each scanning every FL,
+    # the FL it finds is confirmed for this line's own path before it is used
+    scan_path, working_fl = await scan_once(session, current_fl, path, current_fl, scans)
+    if scan_path != path:
+        shared_ok = working_fl is not None and await check_once(
+            session, f"https://fl{working_fl}.moveonjoy.com{path}", checks
+        )
+        if not shared_ok:
+            print(f"   → fl{working_fl or 1} doesn't serve this path, scanning for it alone ...")
+            _, working_fl = await scan_once(session, (current_fl, path), path, current_fl, scans)
+    working_url = f"https://fl{working_fl or 1}.moveonjoy.com{path}"
 
     if working_url != url:
         print(f"   ⚡ REPLACED: fl{current_fl} → {working_url}")
 
-    return working_url
+    return working_url, working_fl
 
 
 async def process_m3u():
     print(f"📄 Loading: {M3U_FILE}")
 
     with open(M3U_FILE, "r", encoding="utf-8") as f:
-        lines = f.readlines()
+        content = f.read()
 
     modified = False
+    last_fl = load_last_fl()
+
+    connector = aiohttp.TCPConnector(
+        resolver=make_resolver(),
+        limit=CONCURRENCY,
+        limit_per_host=PER_HOST_LIMIT,
+        keepalive_timeout=KEEPALIVE,
+        use_dns_cache=True,
+        ttl_dns_cache=DNS_CACHE_TTL,
+    )
+    # Dead FLs fail on connect, so give that phase a much shorter budget
+    timeout = aiohttp.ClientTimeout(total=TIMEOUT, sock_connect=CONNECT_TIMEOUT)
 
-    async with aiohttp.ClientSession() as session:
-        tasks = []
+    async with aiohttp.ClientSession(
+        connector=connector,
+        timeout=timeout,
+        headers={"User-Agent": USER_AGENT},
+    ) as session:
+        scans = {}
+        checks = {}
 
-        for index, line in enumerate(lines):
-            stripped = line.strip()
-            if stripped.startswith("http") and "moveonjoy.com" in stripped.lower():
-                tasks.append((index, fix_url(session, stripped)))
+        # One pass over the whole file finds every MoveOnJoy URL line
+        matches = list(URL_PATTERN.finditer(content))
+        results = await asyncio.gather(*[
+            fix_url(session, match.group(1), int(match.group(2)), match.group(3), scans, checks, last_fl)
+            for match in matches
+        ])
 
-        results = await asyncio.gather(*[task[1] for task in tasks])
+    # Apply replacements by splicing the new URLs between untouched slices
+    parts = []
+    pos = 0
+    for match, (new_url, _) in zip(matches, results):
+        if new_url != match.group(1):
+            modified = True
+            parts.append(content[pos:match.start(1)])
+            parts.append(new_url)
+            pos = match.end(1)
+    parts.append(content[pos:])
 
-        # Apply replacements
-        for (index, _), new_url in zip(tasks, results):
-            if lines[index].strip() != new_url:
-                modified = True
-                lines[index] = new_url + "\n"
+    working = [fl for _, fl in results if fl]
+    if working:
+        save_last_fl(max(working))
 
     if modified:
-        with open(M3U_FILE, "w", encoding="utf-8") as f:
-            f.writelines(lines)
+        # Write next to the playlist and swap it in, so a failed run never
+        # leaves a half-written playlist behind
+        tmp_file = f"{M3U_FILE}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            f.writelines(parts)
+        os.replace(tmp_file, M3U_FILE)
         print(f"\n💾 Saved updates to: {M3U_FILE}")
     else:
         print("\n✨ All MoveOnJoy URLs are already online — no updates needed")
@@ -113,4 +307,4 @@ async def process_m3u():
 
 
 if __name__ == "__main__":
-    asyncio.run(process_m3u())
+    run(process_m3u())